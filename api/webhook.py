@@ -1,13 +1,26 @@
 import requests
 import logging
+import atexit
+import contextvars
+import fcntl
+import functools
+import queue
+import random
 import os
 import re
 import json
 import asyncio
+import heapq
+import time
+import uuid
 import nest_asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
 
 from flask import Flask, request as flask_request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -24,13 +37,112 @@ if not TOKEN:
     logging.error("BOT_TOKEN Environment Variable tidak ditemukan. Aplikasi tidak akan berfungsi.")
 
 MAKE_WEBHOOK_URL = "https://hook.eu2.make.com/b80ogwk3q1wuydgfgwjgq0nsvcwhot96"
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1A2ephAX4I1zwxmvFlkSAeHRc7OjcN2peQqZgPsGZ8X8/edit?gid=550879818#gid=550879818"
+
+# File JSON registry tenant (opsional). Tanpa file ini hanya tenant 'default' (BOT_TOKEN) yang aktif.
+TENANTS_PATH = os.getenv("TENANTS_PATH")
+# Application tenant yang tidak dipakai selama ini dilepas dari memori (0 = tidak pernah).
+# Melepas Application juga membuang conversation & user_data yang sedang berjalan; tenant 'default' tidak pernah dilepas.
+TENANT_IDLE_DETIK = int(os.getenv("TENANT_IDLE_DETIK", "0"))
+
+# --- LOGGING (ASYNC, JSON, SAMPLED) ---
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Porsi update sukses yang log-nya disimpan (0.0 - 1.0). WARNING/ERROR selalu disimpan.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+# Konteks log per update: {'update_id', 'chat_id', 'state', 'mulai', 'sampled'}
+# Disimpan sebagai dict agar perubahan di dalam task asyncio terlihat juga oleh handler Flask.
+log_context = contextvars.ContextVar('log_context', default=None)
+
+def buat_log_context(**fields):
+    """Konteks log baru untuk satu request; keputusan sampling diambil sekali per request."""
+    ctx = {
+        'update_id': None,
+        'chat_id': None,
+        'state': None,
+        'mulai': time.perf_counter(),
+        'sampled': random.random() < LOG_SAMPLE_RATE,
+    }
+    ctx.update(fields)
+    return ctx
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+class LogContextFilter(logging.Filter):
+    """Menempelkan field konteks update ke record dan membuang baris sukses yang tidak tersampel."""
+
+    def filter(self, record):
+        ctx = log_context.get()
+        if ctx is None:
+            sampled = random.random() < LOG_SAMPLE_RATE
+        else:
+            record.update_id = ctx.get('update_id')
+            record.chat_id = ctx.get('chat_id')
+            record.state = ctx.get('state')
+            record.latency_ms = round((time.perf_counter() - ctx['mulai']) * 1000, 1)
+            sampled = ctx['sampled']
+        return sampled or record.levelno >= logging.WARNING
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('update_id', 'chat_id', 'state', 'latency_ms')
+
+    def format(self, record):
+        data = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class AsyncQueueHandler(QueueHandler):
+    """QueueHandler dalam satu proses: record diteruskan apa adanya, format dilakukan di thread listener."""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """INFO/DEBUG ditulis lewat antrean di thread listener; WARNING ke atas ditulis langsung.
+    
+    Vercel bisa membekukan proses begitu response dikirim, sehingga record yang masih di antrean bisa hilang.
+    Error justru yang paling perlu sampai, jadi tidak boleh bergantung pada thread listener.
+    """
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, stream_handler)
+
+    queue_handler = AsyncQueueHandler(log_queue)
+    queue_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    queue_handler.addFilter(LogContextFilter())
+
+    sync_handler = logging.StreamHandler()
+    sync_handler.setLevel(logging.WARNING)
+    sync_handler.setFormatter(JsonFormatter())
+    sync_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler, sync_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx menulis satu baris INFO per request Bot API
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
 
 START_ROUTE, CHOOSE_CATEGORY, GET_NOMINAL, GET_DESCRIPTION, PREVIEW = range(5)
+NAMA_STATE = {
+    START_ROUTE: 'START_ROUTE', CHOOSE_CATEGORY: 'CHOOSE_CATEGORY', GET_NOMINAL: 'GET_NOMINAL',
+    GET_DESCRIPTION: 'GET_DESCRIPTION', PREVIEW: 'PREVIEW', -1: 'END'
+}
 
 KATEGORI_MASUK = {
     'Gaji': 'masuk_gaji', 'Bonus': 'masuk_bonus', 'Hadiah': 'masuk_hadiah',
@@ -45,6 +157,137 @@ KATEGORI_KELUAR = {
     'Rumah': 'keluar_rumah', 'Rumah Tangga': 'keluar_rumahtangga', 'Tabungan': 'keluar_tabungan', 'Admin': 'keluar_admin', 'Lainnya': 'keluar_lainnya'
 }
 
+# --- KONFIGURASI PENYIMPANAN LOKAL ---
+# Vercel hanya mengizinkan penulisan di /tmp, jadi default path diarahkan ke sana.
+# Log transaksi adalah sumber rebuild total budget, index saran dan /ulang saat cold start. Di Vercel /tmp terpisah
+# per instance dan hilang saat recycle, jadi TRANSAKSI_LOG_PATH wajib diarahkan ke storage persisten. Tanpa itu
+# state tersebut hanya berlaku selama instance hidup (total budget bisa kurang hitung setelah cold start).
+# Catatan: instance yang sedang hangat tidak melihat entri yang ditulis instance lain sampai cold start berikutnya.
+TRANSAKSI_LOG_PATH = os.getenv("TRANSAKSI_LOG_PATH") or (None if os.getenv("VERCEL") else "/tmp/keubot_transaksi.jsonl")
+if not TRANSAKSI_LOG_PATH:
+    logging.error("TRANSAKSI_LOG_PATH Environment Variable tidak ditemukan. Total budget hanya berlaku per instance.")
+# Limit budget adalah pengaturan user, bukan cache: di Vercel /tmp hanya hidup selama instance,
+# jadi di deployment BUDGET_PATH wajib diarahkan ke storage persisten. Tanpa itu /budget tidak bisa menyimpan limit.
+BUDGET_PATH = os.getenv("BUDGET_PATH") or (None if os.getenv("VERCEL") else "/tmp/keubot_budget.json")
+if not BUDGET_PATH:
+    logging.error("BUDGET_PATH Environment Variable tidak ditemukan. Limit /budget tidak dapat disimpan.")
+
+# Job rutin adalah pengaturan user dan harus terlihat oleh instance yang menjalankan cron, jadi di Vercel RUTIN_PATH
+# wajib diarahkan ke storage persisten yang dipakai bersama. Tanpa itu /rutin tidak bisa mendaftarkan job.
+RUTIN_PATH = os.getenv("RUTIN_PATH") or (None if os.getenv("VERCEL") else "/tmp/keubot_rutin.json")
+if not RUTIN_PATH:
+    logging.error("RUTIN_PATH Environment Variable tidak ditemukan. Transaksi /rutin tidak dapat didaftarkan.")
+# Endpoint /rutin bisa diakses publik di Vercel, jadi di deployment CRON_SECRET wajib diisi
+# (Vercel Cron mengirimkannya sebagai header Authorization). Tanpa itu /rutin menolak semua request.
+CRON_SECRET = os.getenv("CRON_SECRET")
+CRON_SECRET_WAJIB = bool(os.getenv("VERCEL"))
+if CRON_SECRET_WAJIB and not CRON_SECRET:
+    logging.error("CRON_SECRET Environment Variable tidak ditemukan. Endpoint /rutin dinonaktifkan.")
+
+# Job rutin dijalankan jam 07:00 WIB (= 00:00 UTC, sesuai jadwal cron di vercel.json)
+RUTIN_JAM = 7
+RUTIN_BATCH_SIZE = int(os.getenv("RUTIN_BATCH_SIZE", "100"))
+# Batas waktu satu run cron; harus di bawah maxDuration fungsi. Sisa job yang jatuh tempo tetap di heap untuk run berikutnya.
+RUTIN_BATAS_WAKTU_DETIK = float(os.getenv("RUTIN_BATAS_WAKTU_DETIK", "50"))
+# Batas aman broadcast Bot API (~30 pesan/detik)
+NOTIFIKASI_PER_DETIK = 25
+
+# Batas index saran keterangan (LRU) agar memori tetap terbatas
+KETERANGAN_MAKS_PER_USER = int(os.getenv("KETERANGAN_MAKS_PER_USER", "50"))
+KETERANGAN_MAKS_USER = int(os.getenv("KETERANGAN_MAKS_USER", "1000"))
+JUMLAH_SARAN_KETERANGAN = 4
+
+# Zona waktu WIB untuk menentukan pergantian bulan
+WIB = timezone(timedelta(hours=7))
+
+# --- REGISTRY TENANT (MULTI BOT / MULTI WEBHOOK MAKE) ---
+#
+# Format TENANTS_PATH:
+# {
+#   "kategori_sets": {"keluarga": {"masuk": {"Gaji": "masuk_gaji"}, "keluar": {"Makan": "keluar_makan"}}},
+#   "tenants": {
+#     "rumah_a": {"bot_token": "...", "make_webhook_url": "...", "sheet_url": "...", "kategori": "keluarga",
+#                 "chats": {"-100123": {"make_webhook_url": "...", "sheet_url": "..."}}}
+#   }
+# }
+# Tenant diarahkan per bot lewat /webhook/<tenant_id>; "chats" meng-override konfigurasi per chat.
+
+KATEGORI_SETS = {'default': {'masuk': KATEGORI_MASUK, 'keluar': KATEGORI_KELUAR}}
+
+def buat_tenant(tenant_id, config, base=None):
+    """Menormalkan konfigurasi tenant; nilai yang kosong diwarisi dari base.
+    
+    Hanya tenant default yang memakai MAKE_WEBHOOK_URL/SHEET_URL bawaan, tenant lain tidak boleh
+    jatuh ke webhook dan sheet milik rumah tangga lain.
+    """
+    base = base or {}
+    bawaan = {'make_webhook_url': MAKE_WEBHOOK_URL, 'sheet_url': SHEET_URL} if tenant_id == 'default' else {}
+    kategori_set = KATEGORI_SETS.get(config.get('kategori')) or base.get('kategori_set') or KATEGORI_SETS['default']
+    return {
+        'id': tenant_id,
+        'bot_token': config.get('bot_token') or base.get('bot_token'),
+        'make_webhook_url': config.get('make_webhook_url') or base.get('make_webhook_url') or bawaan.get('make_webhook_url'),
+        'sheet_url': config.get('sheet_url') or base.get('sheet_url') or bawaan.get('sheet_url'),
+        'kategori_set': kategori_set,
+        'kategori_masuk': kategori_set.get('masuk', KATEGORI_MASUK),
+        'kategori_keluar': kategori_set.get('keluar', KATEGORI_KELUAR),
+        'chats': {},
+    }
+
+def load_tenants():
+    tenants = {}
+    if TOKEN:
+        tenants['default'] = buat_tenant('default', {'bot_token': TOKEN})
+
+    if not TENANTS_PATH:
+        return tenants
+
+    try:
+        with open(TENANTS_PATH, encoding='utf-8') as f:
+            registry = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Gagal memuat registry tenant: {e}")
+        return tenants
+
+    KATEGORI_SETS.update(registry.get('kategori_sets', {}))
+
+    for tenant_id, config in registry.get('tenants', {}).items():
+        tenant = buat_tenant(tenant_id, config)
+        if not tenant['bot_token']:
+            logging.error(f"Tenant {tenant_id} tidak memiliki bot_token, dilewati.")
+            continue
+        if not tenant['make_webhook_url'] or not tenant['sheet_url']:
+            logging.error(f"Tenant {tenant_id} tidak memiliki make_webhook_url/sheet_url, dilewati.")
+            continue
+        for chat_id, override in config.get('chats', {}).items():
+            tenant['chats'][int(chat_id)] = buat_tenant(tenant_id, override, base=tenant)
+        tenants[tenant_id] = tenant
+
+    return tenants
+
+TENANTS = load_tenants()
+
+def resolve_tenant(tenant_id, chat_id=None):
+    """Konfigurasi tenant untuk sebuah chat (override per chat jika ada); None jika tenant tidak dikenal."""
+    tenant_id = tenant_id or 'default'
+    tenant = TENANTS.get(tenant_id)
+    if tenant is None:
+        return buat_tenant('default', {}) if tenant_id == 'default' else None
+    return tenant['chats'].get(chat_id, tenant)
+
+def get_tenant_id(context):
+    return context.bot_data.get('tenant_id') or 'default'
+
+def get_tenant(context):
+    return resolve_tenant(get_tenant_id(context), context._chat_id)
+
+def kunci_pemilik(tenant_id, user_id):
+    """Kunci state per user. Dipisah per tenant agar data satu rumah tangga/tim tidak bocor ke tenant lain."""
+    return (tenant_id or 'default', user_id)
+
+def pemilik_entry(entry):
+    return kunci_pemilik(entry.get('tenant_id'), entry.get('user_id'))
+
 # --- FUNGSI UTILITY KRITIS (Workaround Event Loop) ---
 
 async def delete_message_safe(context, chat_id, message_id, log_prefix="Pesan"):
@@ -55,22 +298,76 @@ async def delete_message_safe(context, chat_id, message_id, log_prefix="Pesan"):
 
     try:
         await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logging.info(f"Berhasil menghapus {log_prefix} ID: {message_id} (Safe Delete).")
+        logging.debug("Berhasil menghapus %s ID: %s (Safe Delete).", log_prefix, message_id)
     except Exception as e:
         logging.warning(f"Gagal menghapus {log_prefix} ID: {message_id}. Error: {e}")
         pass
 
-def send_to_make(data):
+# Satu connection pool untuk semua webhook Make (semua tenant)
+make_session = requests.Session()
+
+def send_to_make(data, webhook_url=MAKE_WEBHOOK_URL):
     """Mengirim payload data ke webhook Make."""
     try:
-        response = requests.post(MAKE_WEBHOOK_URL, json=data)
+        response = make_session.post(webhook_url, json=data)
         response.raise_for_status()
-        logging.info(f"Data terkirim ke Make. Status: {response.status_code}")
+        logging.info("Data terkirim ke Make. Status: %s", response.status_code)
         return True
     except requests.exceptions.RequestException as e:
         logging.error(f"Gagal mengirim data ke Make: {e}")
         return False
 
+def catat_log_transaksi(tenant_id, payload, kategori_data):
+    """Menambahkan transaksi yang sudah terkirim ke log lokal (append-only, JSON per baris)."""
+    entry = {
+        'id': uuid.uuid4().hex[:8],
+        'waktu': datetime.now(WIB).isoformat(),
+        'tenant_id': tenant_id or 'default',
+        'user_id': payload.get('user_id'),
+        'transaksi': payload.get('transaksi'),
+        'kategori': kategori_data,
+        'kategori_nama': payload.get('kategori_nama'),
+        'nominal': payload.get('nominal'),
+        'keterangan': payload.get('keterangan'),
+    }
+    if not TRANSAKSI_LOG_PATH:
+        return entry
+    try:
+        with open(TRANSAKSI_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logging.warning(f"Gagal menulis log transaksi lokal: {e}")
+    return entry
+
+def baca_log_transaksi():
+    """Membaca seluruh entri log transaksi lokal. Baris yang rusak dilewati."""
+    if not TRANSAKSI_LOG_PATH:
+        return
+    try:
+        with open(TRANSAKSI_LOG_PATH, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def buat_payload(user, entry):
+    """Menyusun payload Make dari identitas user dan data transaksi (entri log / user_data)."""
+    payload = {
+        'user_id': user.id,
+        'first_name': user.first_name,
+        'username': user.username,
+        'transaksi': entry.get('transaksi'),
+        'kategori_nama': entry.get('kategori_nama'),
+        'nominal': entry.get('nominal'),
+        'keterangan': entry.get('keterangan'),
+    }
+    if not payload['username'] or payload['username'].lower() == 'nousername':
+        payload['username'] = 'NoUsernameSet'
+    return payload
+
 def format_nominal(nominal):
     return "{:,.0f}".format(nominal).replace(",", ".")
 
@@ -95,11 +392,406 @@ def debug_check_ids(context):
     nominal_id = context.user_data.get('nominal_request_message_id')
     
     if nominal_id:
-        logging.info(f"DEBUG: nominal_request_message_id = {nominal_id} (Chat: {chat_id}). ID siap dihapus.")
+        logging.debug("nominal_request_message_id = %s (Chat: %s). ID siap dihapus.", nominal_id, chat_id)
     else:
-        logging.warning(f"DEBUG: nominal_request_message_id TIDAK DITEMUKAN atau None.")
+        logging.debug("nominal_request_message_id TIDAK DITEMUKAN atau None (Chat: %s).", chat_id)
     return nominal_id
 
+# --- BUDGET BULANAN PER KATEGORI ---
+
+# {(tenant_id, user_id): {kategori_data: limit}}
+budget_limits = {}
+# {(tenant_id, user_id, kategori_data): [bulan, total]} -> total berjalan, di-reset lazy saat bulan berganti
+budget_totals = {}
+budget_loaded = False
+
+def bulan_sekarang():
+    return datetime.now(WIB).strftime('%Y-%m')
+
+def load_budget():
+    """Memuat limit budget dari file dan membangun ulang total bulan ini dari log transaksi (sekali per instance)."""
+    global budget_loaded
+
+    if budget_loaded:
+        return
+    budget_loaded = True
+
+    try:
+        if BUDGET_PATH:
+            with open(BUDGET_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+            budget_limits.clear()
+            for tenant_id, users in data.items():
+                for user_id, limits in users.items():
+                    budget_limits[kunci_pemilik(tenant_id, int(user_id))] = {k: int(v) for k, v in limits.items()}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Gagal memuat file budget: {e}")
+
+    rebuild_budget_totals()
+
+def save_budget():
+    data = {}
+    for (tenant_id, user_id), limits in budget_limits.items():
+        data.setdefault(tenant_id, {})[str(user_id)] = limits
+    try:
+        with open(BUDGET_PATH, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    except OSError as e:
+        logging.warning(f"Gagal menyimpan file budget: {e}")
+
+def rebuild_budget_totals():
+    """Menghitung ulang total berjalan bulan ini dari log transaksi lokal."""
+    bulan = bulan_sekarang()
+    budget_totals.clear()
+    for entry in baca_log_transaksi():
+        if not str(entry.get('waktu', '')).startswith(bulan):
+            continue
+        tambah_total_budget(pemilik_entry(entry), entry.get('kategori'), entry.get('nominal'), bulan)
+
+def tambah_total_budget(pemilik, kategori_data, nominal, bulan=None):
+    """Update O(1) total berjalan (pemilik, kategori). Bulan lama otomatis di-reset tanpa scan ulang."""
+    if not pemilik[1] or not kategori_data or not kategori_data.startswith('keluar_'):
+        return 0
+
+    bulan = bulan or bulan_sekarang()
+    key = (*pemilik, kategori_data)
+    slot = budget_totals.get(key)
+    if slot is None or slot[0] != bulan:
+        slot = [bulan, 0]
+        budget_totals[key] = slot
+    slot[1] += int(nominal or 0)
+    return slot[1]
+
+def get_total_budget(pemilik, kategori_data):
+    slot = budget_totals.get((*pemilik, kategori_data))
+    if slot is None or slot[0] != bulan_sekarang():
+        return 0
+    return slot[1]
+
+def cek_budget(pemilik, kategori_data, nominal, kategori_nama=None):
+    """Mencatat pengeluaran ke total berjalan dan mengembalikan teks peringatan jika melewati budget."""
+    load_budget()
+
+    total = tambah_total_budget(pemilik, kategori_data, nominal)
+    limit = budget_limits.get(pemilik, {}).get(kategori_data)
+    if not limit or total <= limit:
+        return ""
+
+    kategori_nama = kategori_nama or kategori_data
+    sebelum = total - int(nominal or 0)
+    if sebelum <= limit:
+        judul = f"⚠️ *Budget {kategori_nama} terlampaui!*"
+    else:
+        judul = f"⚠️ *Budget {kategori_nama} sudah terlampaui.*"
+    return (
+        f"\n\n{judul}\nTotal bulan ini: Rp {format_nominal(total)} "
+        f"dari budget Rp {format_nominal(limit)} (lebih Rp {format_nominal(total - limit)})."
+    )
+
+# --- INDEX SARAN KETERANGAN PER USER ---
+
+# {(tenant_id, user_id): OrderedDict{kunci: {'teks', 'jumlah', 'kategori': {kategori_data: jumlah}}}}
+# Kedua level berurutan LRU: entri paling baru dipakai ada di akhir.
+keterangan_index = OrderedDict()
+keterangan_index_loaded = False
+
+def normalisasi_keterangan(keterangan):
+    return " ".join(str(keterangan or '').split()).lower()
+
+def load_keterangan_index():
+    """Membangun index dari log transaksi lokal (sekali per instance, saat cold start)."""
+    global keterangan_index_loaded
+
+    if keterangan_index_loaded:
+        return
+    keterangan_index_loaded = True
+
+    for entry in baca_log_transaksi():
+        update_keterangan_index(pemilik_entry(entry), entry.get('keterangan'), entry.get('kategori'))
+
+def update_keterangan_index(pemilik, keterangan, kategori_data):
+    """Update incremental index dari satu transaksi yang sudah terkirim."""
+    kunci = normalisasi_keterangan(keterangan)
+    if not pemilik[1] or not kunci:
+        return
+
+    user_index = keterangan_index.get(pemilik)
+    if user_index is None:
+        user_index = keterangan_index[pemilik] = OrderedDict()
+        if len(keterangan_index) > KETERANGAN_MAKS_USER:
+            keterangan_index.popitem(last=False)
+    else:
+        keterangan_index.move_to_end(pemilik)
+
+    item = user_index.get(kunci)
+    if item is None:
+        item = user_index[kunci] = {'teks': keterangan.strip(), 'jumlah': 0, 'kategori': {}}
+        if len(user_index) > KETERANGAN_MAKS_PER_USER:
+            user_index.popitem(last=False)
+    else:
+        user_index.move_to_end(kunci)
+        item['teks'] = keterangan.strip()
+
+    item['jumlah'] += 1
+    if kategori_data:
+        item['kategori'][kategori_data] = item['kategori'].get(kategori_data, 0) + 1
+
+def get_saran_keterangan(pemilik, kategori_data):
+    """Keterangan terbaru user, yang pernah dipakai untuk kategori aktif didahulukan."""
+    load_keterangan_index()
+
+    user_index = keterangan_index.get(pemilik)
+    if not user_index:
+        return []
+
+    terbaru = list(reversed(user_index.values()))
+    terbaru.sort(key=lambda item: kategori_data not in item['kategori'])
+    return [item['teks'] for item in terbaru[:JUMLAH_SARAN_KETERANGAN]]
+
+def get_kategori_dominan(pemilik, keterangan, kategori_dict):
+    """Kategori yang paling sering dipasangkan dengan keterangan ini (hanya dari kategori_dict aktif)."""
+    load_keterangan_index()
+
+    item = keterangan_index.get(pemilik, {}).get(normalisasi_keterangan(keterangan))
+    if not item:
+        return None
+
+    pilihan = [(jumlah, data_cb) for data_cb, jumlah in item['kategori'].items() if data_cb in kategori_dict.values()]
+    if not pilihan:
+        return None
+    data_cb = max(pilihan)[1]
+    nama = next(nama for nama, d in kategori_dict.items() if d == data_cb)
+    return nama, data_cb
+
+# --- TRANSAKSI TERAKHIR & PEMBUKUAN SETELAH TERKIRIM ---
+
+# {(tenant_id, user_id): entri log transaksi terakhir}
+transaksi_terakhir = {}
+transaksi_terakhir_loaded = False
+
+def load_transaksi_terakhir():
+    global transaksi_terakhir_loaded
+
+    if transaksi_terakhir_loaded:
+        return
+    transaksi_terakhir_loaded = True
+
+    for entry in baca_log_transaksi():
+        if entry.get('user_id'):
+            transaksi_terakhir[pemilik_entry(entry)] = entry
+
+def get_transaksi_terakhir(pemilik):
+    load_transaksi_terakhir()
+    return transaksi_terakhir.get(pemilik)
+
+def setelah_terkirim(tenant_id, payload, kategori_data):
+    """Pembukuan lokal setelah transaksi sukses terkirim ke Make. Mengembalikan peringatan budget (jika ada)."""
+    # Loader harus jalan sebelum entri ditulis ke log, kalau tidak entri ini ikut terhitung saat rebuild
+    load_budget()
+    load_keterangan_index()
+    load_transaksi_terakhir()
+
+    entry = catat_log_transaksi(tenant_id, payload, kategori_data)
+    pemilik = pemilik_entry(entry)
+
+    transaksi_terakhir[pemilik] = entry
+
+    update_keterangan_index(pemilik, payload.get('keterangan'), kategori_data)
+
+    return cek_budget(pemilik, kategori_data, payload.get('nominal'), payload.get('kategori_nama'))
+
+def format_ringkasan(payload):
+    transaksi_type = payload.get('transaksi', 'N/A')
+    nominal_formatted = format_nominal(payload.get('nominal', 0))
+    kategori_nama = payload.get('kategori_nama', 'N/A')
+    keterangan = payload.get('keterangan', 'N/A')
+    return f"*Transaksi:* {transaksi_type} Rp {nominal_formatted} - {kategori_nama} ({keterangan})"
+
+def buat_pesan_hasil(payload, success, peringatan_budget="", sheet_url=SHEET_URL):
+    if success:
+        response_text = "✅ *Transaksi Berhasil Dicatat!*\nData Anda telah dikirim ke Spreadsheet.\n\n"
+        response_text += format_ringkasan(payload)
+        response_text += peringatan_budget
+        
+        response_text += f"\n\nCek Laporan Keuangan Anda pada: [Laporan Keuangan]({sheet_url})"
+        response_text += "\n\nJika ingin melakukan pencatatan baru silahkan tekan /start"
+    else:
+        response_text = "❌ *Pencatatan Gagal!*\nTerjadi kesalahan saat mengirim data ke server. Silakan coba lagi /start"
+    return response_text
+
+# --- TRANSAKSI RUTIN (JOB QUEUE BERBASIS HEAP) ---
+
+# {job_id: {'id', 'tenant_id', 'user_id', 'chat_id', 'tanggal', 'jatuh_tempo', 'payload', 'kategori_data'}}
+rutin_jobs = {}
+# [(jatuh_tempo, job_id)] -> entri basi (job dihapus/dijadwal ulang) dilewati saat di-pop
+rutin_heap = []
+
+def jatuh_tempo_berikutnya(tanggal, dari=None):
+    """Timestamp jatuh tempo berikutnya untuk tanggal (1-28) setiap bulan, jam RUTIN_JAM WIB."""
+    dari = dari or datetime.now(WIB)
+    kandidat = dari.replace(day=tanggal, hour=RUTIN_JAM, minute=0, second=0, microsecond=0)
+    if kandidat <= dari:
+        tahun, bulan = (dari.year + 1, 1) if dari.month == 12 else (dari.year, dari.month + 1)
+        kandidat = kandidat.replace(year=tahun, month=bulan)
+    return kandidat.timestamp()
+
+def baca_file_rutin():
+    """Isi file job rutin, {} jika belum ada, None jika gagal dibaca (agar file tidak tertimpa kosong)."""
+    try:
+        with open(RUTIN_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Gagal memuat file transaksi rutin: {e}")
+        return None
+
+def set_rutin_jobs(jobs):
+    """Mengganti state di memori dengan isi storage dan menyusun ulang heap (O(n) heapify)."""
+    rutin_jobs.clear()
+    rutin_jobs.update(jobs)
+    rutin_heap[:] = [(job['jatuh_tempo'], job_id) for job_id, job in rutin_jobs.items()]
+    heapq.heapify(rutin_heap)
+
+def load_rutin():
+    """Memuat ulang job rutin dari storage. Dipanggil sebelum dibaca karena instance lain bisa mengubah file."""
+    if not RUTIN_PATH:
+        return
+    jobs = baca_file_rutin()
+    if jobs is not None:
+        set_rutin_jobs(jobs)
+
+def ubah_rutin(ubah):
+    """Read-modify-write file job rutin di bawah lock, agar perubahan instance lain tidak tertimpa."""
+    if not RUTIN_PATH:
+        return False
+
+    try:
+        with open(RUTIN_PATH + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            jobs = baca_file_rutin()
+            if jobs is None:
+                return False
+            ubah(jobs)
+            tmp_path = RUTIN_PATH + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(jobs, f, ensure_ascii=False)
+            os.replace(tmp_path, RUTIN_PATH)
+    except OSError as e:
+        logging.warning(f"Gagal menyimpan file transaksi rutin: {e}")
+        return False
+
+    set_rutin_jobs(jobs)
+    return True
+
+def tambah_rutin(tenant_id, user_id, chat_id, tanggal, payload, kategori_data):
+    job = {
+        'id': uuid.uuid4().hex[:8],
+        'tenant_id': tenant_id,
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'tanggal': tanggal,
+        'jatuh_tempo': jatuh_tempo_berikutnya(tanggal),
+        'payload': payload,
+        'kategori_data': kategori_data,
+    }
+    if not ubah_rutin(lambda jobs: jobs.__setitem__(job['id'], job)):
+        return None
+    return job
+
+def hapus_rutin(job_id):
+    return ubah_rutin(lambda jobs: jobs.pop(job_id, None))
+
+def get_rutin_user(pemilik):
+    load_rutin()
+    jobs = (job for job in rutin_jobs.values() if pemilik_entry(job) == pemilik)
+    return sorted(jobs, key=lambda job: job['jatuh_tempo'])
+
+async def kirim_notifikasi_rutin(notifikasi, bots, batas):
+    """Notifikasi satu pesan per chat, dijeda sesuai NOTIFIKASI_PER_DETIK dan berhenti saat batas waktu habis."""
+    for i, ((tenant_id, chat_id), daftar) in enumerate(notifikasi.items()):
+        if time.monotonic() >= batas:
+            logging.warning("Batas waktu habis, %s notifikasi rutin tidak terkirim.", len(notifikasi) - i)
+            return
+        text = "🔁 *Transaksi Rutin Berhasil Dicatat!*\n\n" + "\n\n".join(daftar)
+        try:
+            if tenant_id not in bots:
+                aplikasi = get_application(tenant_id or 'default')
+                await aplikasi.initialize()
+                bots[tenant_id] = aplikasi.bot
+            await bots[tenant_id].send_message(chat_id, text, parse_mode='Markdown', disable_web_page_preview=True)
+        except Exception as e:
+            logging.warning(f"Gagal mengirim notifikasi rutin ke chat {chat_id}: {e}")
+        await asyncio.sleep(1 / NOTIFIKASI_PER_DETIK)
+
+async def jalankan_rutin(batas_waktu=RUTIN_BATAS_WAKTU_DETIK):
+    """Menguras job rutin yang jatuh tempo ke Make per batch sampai habis atau batas waktu tercapai."""
+    load_rutin()
+
+    batas = time.monotonic() + batas_waktu
+    bots = {}
+    jumlah_terkirim = 0
+    # Job yang sudah diambil pada run ini tidak diambil lagi, walau storage gagal diperbarui
+    diproses = set()
+
+    while time.monotonic() < batas:
+        sekarang = time.time()
+        batch = []
+        while rutin_heap and rutin_heap[0][0] <= sekarang and len(batch) < RUTIN_BATCH_SIZE:
+            jatuh_tempo, job_id = heapq.heappop(rutin_heap)
+            job = rutin_jobs.get(job_id)
+            if job is None or job['jatuh_tempo'] != jatuh_tempo or job_id in diproses:
+                continue
+            diproses.add(job_id)
+            batch.append(job)
+
+        if not batch:
+            break
+
+        # Satu POST per webhook Make tenant. Make memecah array JSON menjadi satu bundle per item,
+        # jadi skenario tidak perlu diubah.
+        per_webhook = {}
+        for job in batch:
+            tenant = resolve_tenant(job.get('tenant_id'), job['chat_id'])
+            if tenant is None:
+                # Tenant dihapus dari registry: job tetap disimpan, tidak dikirim ke webhook tenant lain
+                logging.warning("Job rutin %s milik tenant tidak dikenal %s dilewati.", job['id'], job.get('tenant_id'))
+                continue
+            per_webhook.setdefault(tenant['make_webhook_url'], []).append(job)
+
+        # Webhook yang gagal tidak menghentikan run: job-nya tetap jatuh tempo di storage dan dicoba lagi
+        # pada run cron berikutnya, sementara job tenant lain tetap dikuras.
+        notifikasi = {}
+        jadwal_baru = {}
+        for webhook_url, jobs in per_webhook.items():
+            if not send_to_make([job['payload'] for job in jobs], webhook_url):
+                continue
+
+            for job in jobs:
+                peringatan_budget = setelah_terkirim(job.get('tenant_id'), job['payload'], job['kategori_data'])
+                key = (job.get('tenant_id'), job['chat_id'])
+                notifikasi.setdefault(key, []).append(format_ringkasan(job['payload']) + peringatan_budget)
+                jadwal_baru[job['id']] = jatuh_tempo_berikutnya(job['tanggal'])
+                jumlah_terkirim += 1
+
+        # Simpan sebelum notifikasi agar job yang sudah terkirim tidak terkirim ulang jika fungsi terhenti.
+        # Hanya jatuh_tempo yang ditulis ke storage, job yang dihapus user sementara itu tidak dihidupkan lagi.
+        def perbarui_jadwal(jobs):
+            for job_id, jatuh_tempo in jadwal_baru.items():
+                if job_id in jobs:
+                    jobs[job_id]['jatuh_tempo'] = jatuh_tempo
+        ubah_rutin(perbarui_jadwal)
+
+        await kirim_notifikasi_rutin(notifikasi, bots, batas)
+
+    sisa = sum(1 for job in rutin_jobs.values() if job['jatuh_tempo'] <= time.time())
+    if sisa:
+        logging.warning("Masih ada %s job rutin jatuh tempo (gagal/di luar batas waktu), dicoba lagi pada run berikutnya.", sisa)
+    logging.info("Transaksi rutin diproses: %s terkirim.", jumlah_terkirim)
+    return jumlah_terkirim
+
 def get_menu_transaksi():
     keyboard = [
         [InlineKeyboardButton("✅ Masuk", callback_data='transaksi_masuk')],
@@ -108,7 +800,17 @@ def get_menu_transaksi():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Cache keyboard kategori per set kategori (dipakai bersama oleh semua tenant)
+menu_kategori_cache = {}
+
 def get_menu_kategori(kategori_dict, route_name):
+    key = tuple(kategori_dict.items())
+    markup = menu_kategori_cache.get(key)
+    if markup is None:
+        markup = menu_kategori_cache[key] = build_menu_kategori(kategori_dict)
+    return markup
+
+def build_menu_kategori(kategori_dict):
     keyboard = []
     row = []
     for nama, data in kategori_dict.items():
@@ -121,7 +823,7 @@ def get_menu_kategori(kategori_dict, route_name):
     keyboard.append([InlineKeyboardButton("⬅️ Kembali ke Menu Transaksi", callback_data='kembali_transaksi')])
     return InlineKeyboardMarkup(keyboard)
 
-def get_menu_preview():
+def get_menu_preview(saran_kategori=None):
     keyboard = [
         [InlineKeyboardButton("✅ Kirim", callback_data='aksi_kirim')],
         [InlineKeyboardButton("Ubah Transaksi", callback_data='ubah_transaksi'),
@@ -129,8 +831,25 @@ def get_menu_preview():
         [InlineKeyboardButton("Ubah Nominal", callback_data='ubah_nominal'),
          InlineKeyboardButton("Ubah Keterangan", callback_data='ubah_keterangan')]
     ]
+    if saran_kategori:
+        keyboard.insert(1, [InlineKeyboardButton(f"🔁 Pakai Kategori {saran_kategori}", callback_data='saran_kategori')])
     return InlineKeyboardMarkup(keyboard)
 
+def get_menu_keterangan(saran):
+    """Tombol saran keterangan (callback memakai index karena batas 64 byte callback_data)."""
+    keyboard = [[InlineKeyboardButton(teks[:40], callback_data=f'saran_ket_{i}')] for i, teks in enumerate(saran)]
+    keyboard.append([InlineKeyboardButton("⬅️ Kembali ke Menu Sebelumnya", callback_data='kembali_nominal')])
+    return InlineKeyboardMarkup(keyboard)
+
+def siapkan_menu_keterangan(context):
+    """Menyusun menu permintaan keterangan beserta saran dari index user."""
+    pemilik = kunci_pemilik(get_tenant_id(context), context.user_data.get('user_id'))
+    saran = get_saran_keterangan(pemilik, context.user_data.get('kategori_data'))
+    context.user_data['saran_keterangan'] = saran
+    if not saran:
+        return get_menu_kembali('kembali_nominal')
+    return get_menu_keterangan(saran)
+
 def get_menu_kembali(callback_data):
     keyboard = [
         [InlineKeyboardButton("⬅️ Kembali ke Menu Sebelumnya", callback_data=callback_data)],
@@ -139,6 +858,28 @@ def get_menu_kembali(callback_data):
 
 # --- HANDLERS UTAMA (Semua fungsi async) ---
 
+def dengan_log_state(callback, state=None):
+    """Membungkus handler conversation agar state tercatat di konteks log.
+    
+    Sebelum handler jalan, konteks diisi state conversation saat ini: state tempat handler didaftarkan,
+    atau (untuk entry point/fallback) state terakhir yang dicatat di user_data. Setelah transisi diperbarui.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context):
+        ctx = log_context.get()
+        sebelum = NAMA_STATE[state] if state is not None else context.user_data.get('log_state')
+        if ctx is not None:
+            ctx['state'] = sebelum
+        
+        hasil = await callback(update, context)
+        if hasil is not None:
+            context.user_data['log_state'] = NAMA_STATE.get(hasil, hasil)
+            if ctx is not None:
+                ctx['state'] = context.user_data['log_state']
+        logging.debug("Transisi state oleh %s: %s -> %s", callback.__name__, sebelum, hasil)
+        return hasil
+    return wrapper
+
 async def start(update: Update, context):
     
     user = update.effective_user
@@ -174,7 +915,7 @@ async def start(update: Update, context):
                 text=text,
                 reply_markup=get_menu_transaksi()
             )
-            logging.info(f"Pesan 'start' berhasil dikirim ke chat {chat_id}")
+            logging.debug("Pesan 'start' berhasil dikirim ke chat %s", chat_id)
             
             # KRITIS: Simpan ID menu awal agar bisa dihapus oleh /cancel
             context.user_data['start_menu_id'] = menu_message.message_id
@@ -280,6 +1021,177 @@ async def cancel(update: Update, context):
         
     return ConversationHandler.END
 
+async def budget_command(update: Update, context):
+    """/budget -> daftar budget, /budget <Kategori> <nominal> -> set limit (0 untuk menghapus)."""
+    load_budget()
+
+    pemilik = kunci_pemilik(get_tenant_id(context), update.effective_user.id)
+    args = context.args or []
+    limits = budget_limits.setdefault(pemilik, {})
+    kategori_keluar = get_tenant(context)['kategori_keluar']
+
+    if not args:
+        if not limits:
+            text = "Belum ada budget yang diatur.\nGunakan: `/budget Makan 1500000`"
+        else:
+            text = f"*Budget Bulan {bulan_sekarang()}:*\n\n"
+            for nama, data_cb in kategori_keluar.items():
+                if data_cb not in limits:
+                    continue
+                total = get_total_budget(pemilik, data_cb)
+                status = "⚠️" if total > limits[data_cb] else "✅"
+                text += f"{status} *{nama}:* Rp {format_nominal(total)} / Rp {format_nominal(limits[data_cb])}\n"
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
+
+    try:
+        nominal = int(re.sub(r'\D', '', args[-1]))
+    except ValueError:
+        nominal = None
+
+    nama_input = " ".join(args[:-1]).strip().lower()
+    kategori = next(((nama, data_cb) for nama, data_cb in kategori_keluar.items() if nama.lower() == nama_input), None)
+
+    if nominal is None or kategori is None:
+        daftar = ", ".join(kategori_keluar.keys())
+        await update.message.reply_text(
+            f"Format tidak valid. Gunakan: `/budget <Kategori> <nominal>`\nKategori: {daftar}",
+            parse_mode='Markdown'
+        )
+        return
+
+    if not BUDGET_PATH:
+        await update.message.reply_text("⚠️ Penyimpanan budget belum dikonfigurasi (BUDGET_PATH). Hubungi admin bot.")
+        return
+
+    nama, data_cb = kategori
+    if nominal == 0:
+        limits.pop(data_cb, None)
+        text = f"Budget *{nama}* dihapus."
+    else:
+        limits[data_cb] = nominal
+        total = get_total_budget(pemilik, data_cb)
+        text = f"Budget *{nama}* diatur ke Rp {format_nominal(nominal)} per bulan.\n"
+        text += f"Terpakai bulan ini: Rp {format_nominal(total)}."
+    save_budget()
+
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def ulang_command(update: Update, context):
+    """/ulang -> menampilkan transaksi terakhir dengan tombol kirim ulang satu tap."""
+    entry = get_transaksi_terakhir(kunci_pemilik(get_tenant_id(context), update.effective_user.id))
+    
+    if not entry:
+        await update.message.reply_text("Belum ada transaksi yang bisa diulang. Silakan gunakan /start.")
+        return
+    
+    text = "🔁 *Ulangi Transaksi Terakhir?*\n\n" + format_ringkasan(entry)
+    # Tombol diikat ke pemilik dan entri yang ditampilkan, bukan ke siapa pun yang menekan
+    callback_data = f"ulang_kirim_{update.effective_user.id}_{entry['id']}"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Kirim Ulang", callback_data=callback_data)]])
+    await update.message.reply_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    await delete_message_safe(context, update.effective_chat.id, update.message.message_id, "pesan /ulang user")
+
+async def ulang_kirim(update: Update, context):
+    query = update.callback_query
+    
+    _, _, owner_id, entry_id = query.data.split('_', 3)
+    entry = get_transaksi_terakhir(kunci_pemilik(get_tenant_id(context), query.from_user.id))
+    
+    if int(owner_id) != query.from_user.id:
+        alasan = "Tombol ini milik pengguna lain."
+    elif not entry or entry['id'] != entry_id:
+        alasan = "Transaksi ini sudah bukan transaksi terakhir Anda. Gunakan /ulang lagi."
+    else:
+        alasan = None
+    
+    try:
+        await query.answer(alasan, show_alert=bool(alasan))
+    except Exception:
+        pass
+    
+    if alasan:
+        return
+    
+    tenant = get_tenant(context)
+    payload = buat_payload(query.from_user, entry)
+    success = send_to_make(payload, tenant['make_webhook_url'])
+    
+    peringatan_budget = ""
+    if success:
+        peringatan_budget = setelah_terkirim(get_tenant_id(context), payload, entry.get('kategori'))
+    
+    try:
+        await query.edit_message_text(
+            buat_pesan_hasil(payload, success, peringatan_budget, tenant['sheet_url']),
+            parse_mode='Markdown',
+            disable_web_page_preview=True
+        )
+    except Exception as e:
+        logging.warning(f"Gagal edit pesan hasil /ulang: {e}")
+
+async def rutin_command(update: Update, context):
+    """/rutin -> daftar, /rutin <tanggal> -> jadikan transaksi terakhir rutin bulanan, /rutin hapus <no>."""
+    user_id = update.effective_user.id
+    pemilik = kunci_pemilik(get_tenant_id(context), user_id)
+    args = context.args or []
+    jobs = get_rutin_user(pemilik)
+    
+    if not args:
+        if not jobs:
+            text = "Belum ada transaksi rutin.\n"
+        else:
+            text = "*Transaksi Rutin:*\n\n"
+            for i, job in enumerate(jobs, 1):
+                text += f"{i}. Tanggal {job['tanggal']}: {format_ringkasan(job['payload'])}\n"
+        text += "\nGunakan `/rutin <tanggal 1-28>` untuk menjadikan transaksi terakhir rutin bulanan, "
+        text += "atau `/rutin hapus <nomor>` untuk menghapus."
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
+    
+    if args[0].lower() == 'hapus':
+        try:
+            nomor = int(args[1])
+            if not 1 <= nomor <= len(jobs):
+                raise ValueError
+            job = jobs[nomor - 1]
+        except (IndexError, ValueError):
+            await update.message.reply_text("Nomor transaksi rutin tidak valid. Lihat daftar dengan /rutin.")
+            return
+        if not hapus_rutin(job['id']):
+            await update.message.reply_text("❌ Gagal menghapus transaksi rutin. Silakan coba lagi.")
+            return
+        await update.message.reply_text(f"Transaksi rutin dihapus:\n{format_ringkasan(job['payload'])}", parse_mode='Markdown')
+        return
+    
+    if not RUTIN_PATH:
+        await update.message.reply_text("⚠️ Penyimpanan transaksi rutin belum dikonfigurasi (RUTIN_PATH). Hubungi admin bot.")
+        return
+    
+    try:
+        tanggal = int(args[0])
+        if not 1 <= tanggal <= 28:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Tanggal tidak valid. Gunakan angka 1-28, misalnya `/rutin 5`.", parse_mode='Markdown')
+        return
+    
+    entry = get_transaksi_terakhir(pemilik)
+    if not entry:
+        await update.message.reply_text("Belum ada transaksi terakhir. Catat dulu dengan /start, lalu gunakan /rutin.")
+        return
+    
+    payload = buat_payload(update.effective_user, entry)
+    job = tambah_rutin(get_tenant_id(context), user_id, update.effective_chat.id, tanggal, payload, entry.get('kategori'))
+    if job is None:
+        await update.message.reply_text("❌ Gagal menyimpan transaksi rutin. Silakan coba lagi.")
+        return
+    jadwal = datetime.fromtimestamp(job['jatuh_tempo'], WIB).strftime('%d-%m-%Y %H:%M')
+    
+    text = f"✅ Transaksi rutin setiap tanggal *{tanggal}* berhasil didaftarkan.\n\n{format_ringkasan(payload)}\n\n"
+    text += f"Jadwal berikutnya: {jadwal} WIB"
+    await update.message.reply_text(text, parse_mode='Markdown')
+
 async def choose_route(update: Update, context):
     query = update.callback_query
     
@@ -293,18 +1205,19 @@ async def choose_route(update: Update, context):
     data = query.data
     chat_id = query.message.chat_id
     text = ""
+    tenant = get_tenant(context)
     
     if data == 'transaksi_masuk':
         context.user_data['transaksi'] = 'Masuk'
-        context.user_data['kategori_dict'] = KATEGORI_MASUK
+        context.user_data['kategori_dict'] = tenant['kategori_masuk']
         text = "Silahkan pilih *Kategori* dari Pemasukan:"
     elif data == 'transaksi_keluar':
         context.user_data['transaksi'] = 'Keluar'
-        context.user_data['kategori_dict'] = KATEGORI_KELUAR
+        context.user_data['kategori_dict'] = tenant['kategori_keluar']
         text = "Silahkan pilih *Kategori* dari Pengeluaran:"
     elif data == 'transaksi_tabungan':
         context.user_data['transaksi'] = 'Tabungan'
-        context.user_data['kategori_dict'] = KATEGORI_KELUAR
+        context.user_data['kategori_dict'] = tenant['kategori_keluar']
         text = "Anda memilih *Tabungan*. Pengeluaran akan dilakukan dari Tabungan. Silahkan Pilih *Kategori*:"
     else:
         await context.bot.send_message(chat_id, "Terjadi kesalahan. Silakan mulai ulang dengan /start.")
@@ -354,6 +1267,7 @@ async def choose_category(update: Update, context):
     kategori_nama = next((nama for nama, data_cb in kategori_dict.items() if data_cb == data), 'N/A')
     
     context.user_data['kategori_nama'] = kategori_nama
+    context.user_data['kategori_data'] = data
     
     text = f"Anda memilih *Transaksi {context.user_data['transaksi']}* dengan *Kategori {kategori_nama}*.\n\n"
     text += "Sekarang, *tuliskan jumlah nominal transaksi* (hanya angka, tanpa titik/koma/Rp):"
@@ -427,7 +1341,7 @@ async def get_nominal(update: Update, context):
     
     sent_message = await update.message.reply_text(
         text, 
-        reply_markup=get_menu_kembali('kembali_nominal'), 
+        reply_markup=siapkan_menu_keterangan(context), 
         parse_mode='Markdown'
     )
     context.user_data['description_request_message_id'] = sent_message.message_id
@@ -452,15 +1366,77 @@ async def get_description(update: Update, context):
         
     # --- Lanjut ke Preview ---
             
-    preview_text = generate_preview(context.user_data)
+    await kirim_preview(context, chat_id)
     
-    preview_message = await update.message.reply_text(
-        preview_text,
-        reply_markup=get_menu_preview(),
+    return PREVIEW
+
+async def kirim_preview(context, chat_id):
+    """Mengirim pesan preview, dengan saran kategori jika keterangan biasanya dicatat di kategori lain."""
+    saran = get_kategori_dominan(
+        kunci_pemilik(get_tenant_id(context), context.user_data.get('user_id')),
+        context.user_data.get('keterangan'),
+        context.user_data.get('kategori_dict', {})
+    )
+    if saran and saran[1] != context.user_data.get('kategori_data'):
+        context.user_data['saran_kategori'] = saran
+    else:
+        context.user_data.pop('saran_kategori', None)
+        saran = None
+
+    preview_message = await context.bot.send_message(
+        chat_id,
+        generate_preview(context.user_data),
+        reply_markup=get_menu_preview(saran[0] if saran else None),
         parse_mode='Markdown'
     )
     context.user_data['preview_message_id'] = preview_message.message_id
-    # ---------------------------------------------------------
+
+async def pilih_saran_keterangan(update: Update, context):
+    query = update.callback_query
+    chat_id = query.message.chat_id
+    
+    try:
+        await query.answer()
+    except Exception:
+        pass
+    
+    saran = context.user_data.get('saran_keterangan') or []
+    index = int(query.data.rsplit('_', 1)[1])
+    if index >= len(saran):
+        return PREVIEW
+    
+    context.user_data['keterangan'] = saran[index]
+    
+    # Pesan permintaan keterangan adalah pesan yang membawa tombol ini
+    context.user_data.pop('description_request_message_id', None)
+    await delete_message_safe(context, chat_id, query.message.message_id, "Deskripsi Request")
+    
+    await kirim_preview(context, chat_id)
+    
+    return PREVIEW
+
+async def pilih_saran_kategori(update: Update, context):
+    query = update.callback_query
+    
+    try:
+        await query.answer()
+    except Exception:
+        pass
+    
+    saran = context.user_data.pop('saran_kategori', None)
+    if not saran:
+        return PREVIEW
+    
+    context.user_data['kategori_nama'], context.user_data['kategori_data'] = saran
+    
+    try:
+        await query.edit_message_text(
+            generate_preview(context.user_data),
+            reply_markup=get_menu_preview(),
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logging.warning(f"Gagal edit pesan preview saat ganti kategori: {e}")
     
     return PREVIEW
     
@@ -554,23 +1530,14 @@ async def handle_preview_actions(update: Update, context):
         if not current_username or current_username.lower() == 'nousername':
             payload['username'] = 'NoUsernameSet'
         
-        success = send_to_make(payload)
+        tenant = get_tenant(context)
+        success = send_to_make(payload, tenant['make_webhook_url'])
         
-        transaksi_type = payload.get('transaksi', 'N/A')
-        nominal_formatted = format_nominal(payload.get('nominal', 0))
-        kategori_nama = payload.get('kategori_nama', 'N/A')
-        keterangan = payload.get('keterangan', 'N/A')
-
-        ringkasan_data = f"*Transaksi:* {transaksi_type} Rp {nominal_formatted} - {kategori_nama} ({keterangan})"
-
+        peringatan_budget = ""
         if success:
-            response_text = "✅ *Transaksi Berhasil Dicatat!*\nData Anda telah dikirim ke Spreadsheet.\n\n"
-            response_text += ringkasan_data
-            
-            response_text += "\n\nCek Laporan Keuangan Anda pada: [Laporan Keuangan](https://docs.google.com/spreadsheets/d/1A2ephAX4I1zwxmvFlkSAeHRc7OjcN2peQqZgPsGZ8X8/edit?gid=550879818#gid=550879818)"
-            response_text += "\n\nJika ingin melakukan pencatatan baru silahkan tekan /start"
-        else:
-            response_text = "❌ *Pencatatan Gagal!*\nTerjadi kesalahan saat mengirim data ke server. Silakan coba lagi /start"
+            peringatan_budget = setelah_terkirim(get_tenant_id(context), payload, context.user_data.get('kategori_data'))
+        
+        response_text = buat_pesan_hasil(payload, success, peringatan_budget, tenant['sheet_url'])
 
         await context.bot.send_message(
             chat_id,
@@ -633,7 +1600,7 @@ async def handle_preview_actions(update: Update, context):
         sent_message = await context.bot.send_message(
              chat_id,
              text,
-             reply_markup=get_menu_kembali('kembali_nominal'),
+             reply_markup=siapkan_menu_keterangan(context),
              parse_mode='Markdown'
            )
         
@@ -656,45 +1623,90 @@ except RuntimeError:
 # Inisialisasi Flask App (Vercel akan mencari instance 'app')
 app = Flask(__name__)
 
-# Deklarasi global untuk Application instance
-application_instance = None
+# Application per tenant, dibuat lazy: {tenant_id: [application, terakhir_dipakai]} (urutan LRU)
+applications = OrderedDict()
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """Request Bot API yang dipakai bersama: shutdown dari satu Application tidak boleh menutup pool tenant lain."""
+
+    async def shutdown(self):
+        pass
 
-def init_application():
-    """Menginisialisasi Application dan Conversation Handler."""
-    global application_instance
+# Satu connection pool Bot API yang dipakai bersama oleh semua tenant
+bot_request = SharedHTTPXRequest(connection_pool_size=int(os.getenv("BOT_POOL_SIZE", "32")))
+
+async def lepas_application_idle():
+    """Shutdown dan lepas Application tenant yang idle lebih dari TENANT_IDLE_DETIK (kecuali 'default')."""
+    if not TENANT_IDLE_DETIK:
+        return
     
-    if not TOKEN:
+    sekarang = time.time()
+    for tenant_id, (application, terakhir_dipakai) in list(applications.items()):
+        if sekarang - terakhir_dipakai < TENANT_IDLE_DETIK:
+            break
+        if tenant_id == 'default':
+            continue
+        applications.pop(tenant_id)
+        try:
+            await application.shutdown()
+        except Exception as e:
+            logging.warning(f"Gagal shutdown Application tenant {tenant_id}: {e}")
+        logging.info("Application tenant %s dilepas karena idle.", tenant_id)
+
+def get_application(tenant_id):
+    """Mengambil Application tenant, dibuat lazy saat pertama kali dipakai."""
+    sekarang = time.time()
+    
+    slot = applications.get(tenant_id)
+    if slot is None:
+        application = init_application(tenant_id)
+        if application is None:
+            return None
+        slot = applications[tenant_id] = [application, sekarang]
+    else:
+        applications.move_to_end(tenant_id)
+        slot[1] = sekarang
+    return slot[0]
+
+def init_application(tenant_id='default'):
+    """Menginisialisasi Application dan Conversation Handler untuk satu tenant."""
+    tenant = TENANTS.get(tenant_id)
+    
+    if not tenant:
         return None
 
     try:
-        application = Application.builder().token(TOKEN).build()
+        application = Application.builder().token(tenant['bot_token']).request(bot_request).build()
+        application.bot_data['tenant_id'] = tenant_id
         
         conv_handler = ConversationHandler(
             entry_points=[
-                CommandHandler("start", start),
+                CommandHandler("start", dengan_log_state(start)),
             ],
             states={
                 CHOOSE_CATEGORY: [
-                    CallbackQueryHandler(choose_route, pattern=r'^transaksi_(masuk|keluar|tabungan)$')
+                    CallbackQueryHandler(dengan_log_state(choose_route, CHOOSE_CATEGORY), pattern=r'^transaksi_(masuk|keluar|tabungan)$')
                 ],
                 
                 GET_NOMINAL: [
-                    CallbackQueryHandler(choose_category, pattern=r'^(masuk|keluar)_.*$|^kembali_transaksi$')
+                    CallbackQueryHandler(dengan_log_state(choose_category, GET_NOMINAL), pattern=r'^(masuk|keluar)_.*$|^kembali_transaksi$')
                 ],
                 
                 GET_DESCRIPTION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_nominal),
-                    CallbackQueryHandler(handle_kembali_actions, pattern=r'^kembali_kategori$'),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, dengan_log_state(get_nominal, GET_DESCRIPTION)),
+                    CallbackQueryHandler(dengan_log_state(handle_kembali_actions, GET_DESCRIPTION), pattern=r'^kembali_kategori$'),
                 ],
                 
                 PREVIEW: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_description),
-                    CallbackQueryHandler(handle_kembali_actions, pattern=r'^kembali_nominal$'),
-                    CallbackQueryHandler(handle_preview_actions, pattern=r'^aksi_.*|ubah_.*$'),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, dengan_log_state(get_description, PREVIEW)),
+                    CallbackQueryHandler(dengan_log_state(handle_kembali_actions, PREVIEW), pattern=r'^kembali_nominal$'),
+                    CallbackQueryHandler(dengan_log_state(handle_preview_actions, PREVIEW), pattern=r'^aksi_.*|ubah_.*$'),
+                    CallbackQueryHandler(dengan_log_state(pilih_saran_keterangan, PREVIEW), pattern=r'^saran_ket_\d+$'),
+                    CallbackQueryHandler(dengan_log_state(pilih_saran_kategori, PREVIEW), pattern=r'^saran_kategori$'),
                 ]
             },
             fallbacks=[
-                CommandHandler("cancel", cancel),
+                CommandHandler("cancel", dengan_log_state(cancel)),
             ],
             per_user=True,
             per_chat=True,
@@ -702,7 +1714,11 @@ def init_application():
         )
 
         application.add_handler(conv_handler)
-        logging.info("Aplikasi Telegram berhasil diinisialisasi.")
+        application.add_handler(CommandHandler("budget", budget_command))
+        application.add_handler(CommandHandler("ulang", ulang_command))
+        application.add_handler(CommandHandler("rutin", rutin_command))
+        application.add_handler(CallbackQueryHandler(ulang_kirim, pattern=r'^ulang_kirim_\d+_\w+$'))
+        logging.info("Aplikasi Telegram tenant %s berhasil diinisialisasi.", tenant_id)
         return application
         
     except Exception as e:
@@ -711,14 +1727,20 @@ def init_application():
 
 
 @app.route('/webhook', methods=['POST'])
-def flask_webhook_handler():
+@app.route('/webhook/<tenant_id>', methods=['POST'])
+def flask_webhook_handler(tenant_id='default'):
     """Fungsi handler Vercel/Flask. Pola Loop Baru per Request + Policy."""
     
-    global application_instance
-    
-    # 1. Lazy Loading/Re-initialization
-    if application_instance is None:
-        application_instance = init_application()
+    # Konteks log dipasang di awal dan selalu di-reset, agar thread worker yang dipakai ulang tidak membawa konteks lama
+    token = log_context.set(buat_log_context())
+    try:
+        return proses_webhook(tenant_id)
+    finally:
+        log_context.reset(token)
+
+def proses_webhook(tenant_id):
+    # 1. Lazy Loading/Re-initialization (per tenant)
+    application_instance = get_application(tenant_id)
     
     if application_instance is None:
         logging.error("Application instance tidak ditemukan.")
@@ -733,6 +1755,10 @@ def flask_webhook_handler():
     try:
         update = Update.de_json(data, application_instance.bot)
         
+        ctx = log_context.get()
+        ctx['update_id'] = update.update_id
+        ctx['chat_id'] = update.effective_chat.id if update.effective_chat else None
+        
         # --- PERBAIKAN KRITIS UNTUK FINAL EVENT LOOP ---
         
         # 1. Tentukan Event Loop Policy (Penting untuk thread-safety di serverless)
@@ -744,11 +1770,14 @@ def flask_webhook_handler():
         
         # 3. PANGGIL INITIALIZE PADA SETIAP REQUEST
         new_loop.run_until_complete(application_instance.initialize())
-        logging.info("Application instance berhasil di-reset koneksi HTTP-nya.")
+        logging.debug("Application instance berhasil di-reset koneksi HTTP-nya.")
             
         # 4. Jalankan pemrosesan update di loop baru
         new_loop.run_until_complete(application_instance.process_update(update))
         
+        # 5. Lepas Application tenant lain yang sudah idle (opt-in lewat TENANT_IDLE_DETIK)
+        new_loop.run_until_complete(lepas_application_idle())
+        
         # ------------------------------------------------------
 
         logging.info("Update Telegram berhasil diproses oleh Application (Async complete).")
@@ -758,16 +1787,34 @@ def flask_webhook_handler():
         # PENTING: Set loop kembali ke None saat error untuk menghindari konflik pada request berikutnya
         asyncio.set_event_loop(None)
         
-        logging.error(f"Error saat memproses Update: {e}")
+        logging.error(f"Error saat memproses Update: {e}", exc_info=True)
         return 'Internal Server Error', 500
 
 
-
-
-
-
-
-
-
-
-
+@app.route('/rutin', methods=['GET', 'POST'])
+def flask_rutin_handler():
+    """Endpoint Vercel Cron untuk menjalankan transaksi rutin yang jatuh tempo."""
+    
+    if not CRON_SECRET:
+        if CRON_SECRET_WAJIB:
+            return 'Service Unavailable', 503
+    elif flask_request.headers.get('Authorization') != f"Bearer {CRON_SECRET}":
+        return 'Unauthorized', 401
+    
+    token = log_context.set(buat_log_context(state='RUTIN'))
+    try:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+        new_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(new_loop)
+        
+        jumlah = new_loop.run_until_complete(jalankan_rutin())
+        return f'OK ({jumlah})', 200
+    
+    except Exception as e:
+        asyncio.set_event_loop(None)
+        
+        logging.error(f"Error saat menjalankan transaksi rutin: {e}", exc_info=True)
+        return 'Internal Server Error', 500
+    
+    finally:
+        log_context.reset(token)
@@ -0,0 +1,483 @@
+import asyncio
+import io
+import json
+import logging
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("flask")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'api'))
+
+import webhook  # noqa: E402
+
+PEMILIK = ('default', 1)
+
+
+@pytest.fixture
+def cold_start(tmp_path, monkeypatch):
+    """Mensimulasikan instance baru: state di memori kosong, file lokal di tmp_path."""
+    monkeypatch.setattr(webhook, 'TRANSAKSI_LOG_PATH', str(tmp_path / 'transaksi.jsonl'))
+    monkeypatch.setattr(webhook, 'BUDGET_PATH', str(tmp_path / 'budget.json'))
+    monkeypatch.setattr(webhook, 'budget_loaded', False)
+    monkeypatch.setattr(webhook, 'keterangan_index_loaded', False)
+    monkeypatch.setattr(webhook, 'transaksi_terakhir_loaded', False)
+    monkeypatch.setattr(webhook, 'RUTIN_PATH', str(tmp_path / 'rutin.json'))
+    webhook.rutin_jobs.clear()
+    webhook.rutin_heap.clear()
+    webhook.budget_limits.clear()
+    webhook.budget_totals.clear()
+    webhook.keterangan_index.clear()
+    webhook.transaksi_terakhir.clear()
+    return tmp_path
+
+
+def payload(nominal, keterangan='Bubur Ayam'):
+    return {
+        'user_id': 1, 'first_name': 'A', 'username': 'a', 'transaksi': 'Keluar',
+        'kategori_nama': 'Makan', 'nominal': nominal, 'keterangan': keterangan,
+    }
+
+
+def test_entri_pertama_setelah_cold_start_tidak_dihitung_dua_kali(cold_start):
+    (cold_start / 'budget.json').write_text(json.dumps({'default': {'1': {'keluar_makan': 100000}}}))
+
+    peringatan = webhook.setelah_terkirim('default', payload(60000), 'keluar_makan')
+
+    assert peringatan == ""
+    assert webhook.get_total_budget(PEMILIK, 'keluar_makan') == 60000
+
+
+def test_rebuild_total_dari_log_saat_cold_start(cold_start):
+    (cold_start / 'budget.json').write_text(json.dumps({'default': {'1': {'keluar_makan': 100000}}}))
+    webhook.catat_log_transaksi('default', payload(60000), 'keluar_makan')
+
+    peringatan = webhook.setelah_terkirim('default', payload(50000), 'keluar_makan')
+
+    assert webhook.get_total_budget(PEMILIK, 'keluar_makan') == 110000
+    assert 'terlampaui' in peringatan
+
+
+def test_index_keterangan_entri_pertama_setelah_cold_start(cold_start):
+    webhook.setelah_terkirim('default', payload(15000), 'keluar_makan')
+
+    item = webhook.keterangan_index[PEMILIK]['bubur ayam']
+    assert item['jumlah'] == 1
+    assert item['kategori'] == {'keluar_makan': 1}
+
+
+class FakeQuery:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, first_name='A', username='a')
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def tekan_ulang(data, user_id, monkeypatch, tenant_id='default'):
+    terkirim = []
+    monkeypatch.setattr(webhook, 'send_to_make', lambda data, url=None: terkirim.append(data) or True)
+    query = FakeQuery(data, user_id)
+    context = SimpleNamespace(bot_data={'tenant_id': tenant_id}, _chat_id=user_id)
+    asyncio.run(webhook.ulang_kirim(SimpleNamespace(callback_query=query), context))
+    return query, terkirim
+
+
+def test_ulang_kirim_menolak_tombol_milik_user_lain(cold_start, monkeypatch):
+    webhook.setelah_terkirim('default', payload(15000), 'keluar_makan')
+    entry = webhook.get_transaksi_terakhir(PEMILIK)
+
+    query, terkirim = tekan_ulang(f"ulang_kirim_1_{entry['id']}", 2, monkeypatch)
+
+    assert terkirim == []
+    assert query.answers[0]
+
+
+def test_ulang_kirim_menolak_entri_yang_sudah_bukan_terakhir(cold_start, monkeypatch):
+    webhook.setelah_terkirim('default', payload(15000), 'keluar_makan')
+    lama = webhook.get_transaksi_terakhir(PEMILIK)
+    webhook.setelah_terkirim('default', payload(20000, 'Bayar Listrik'), 'keluar_rumah')
+
+    query, terkirim = tekan_ulang(f"ulang_kirim_1_{lama['id']}", 1, monkeypatch)
+
+    assert terkirim == []
+
+
+def test_ulang_kirim_mengirim_entri_yang_ditampilkan(cold_start, monkeypatch):
+    webhook.setelah_terkirim('default', payload(15000), 'keluar_makan')
+    entry = webhook.get_transaksi_terakhir(PEMILIK)
+
+    query, terkirim = tekan_ulang(f"ulang_kirim_1_{entry['id']}", 1, monkeypatch)
+
+    assert [p['nominal'] for p in terkirim] == [15000]
+    assert query.answers == [None]
+
+
+def jatuh_tempo_sekarang(job_ids):
+    def ubah(jobs):
+        for job_id in job_ids:
+            jobs[job_id]['jatuh_tempo'] = 0
+    webhook.ubah_rutin(ubah)
+
+
+def test_jalankan_rutin_menguras_semua_batch_yang_jatuh_tempo(cold_start, monkeypatch):
+    batches = []
+    monkeypatch.setattr(webhook, 'RUTIN_BATCH_SIZE', 2)
+    monkeypatch.setattr(webhook, 'send_to_make', lambda data, url=None: batches.append(data) or True)
+
+    async def tanpa_notifikasi(notifikasi, bots, batas):
+        pass
+    monkeypatch.setattr(webhook, 'kirim_notifikasi_rutin', tanpa_notifikasi)
+
+    for _ in range(5):
+        webhook.tambah_rutin('default', 1, 1, 5, payload(1000), 'keluar_makan')
+    jatuh_tempo_sekarang(list(webhook.rutin_jobs))
+
+    jumlah = asyncio.run(webhook.jalankan_rutin())
+
+    assert jumlah == 5
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert not webhook.rutin_heap[0][0] <= webhook.time.time()
+
+
+def test_state_user_dipisah_per_tenant(cold_start, monkeypatch):
+    webhook.setelah_terkirim('rumah_a', payload(15000), 'keluar_makan')
+    entry = webhook.get_transaksi_terakhir(('rumah_a', 1))
+
+    query, terkirim = tekan_ulang(f"ulang_kirim_1_{entry['id']}", 1, monkeypatch, tenant_id='rumah_b')
+
+    assert terkirim == []
+    assert webhook.get_transaksi_terakhir(('rumah_b', 1)) is None
+    assert webhook.get_saran_keterangan(('rumah_b', 1), 'keluar_makan') == []
+    assert webhook.get_total_budget(('rumah_b', 1), 'keluar_makan') == 0
+    assert webhook.get_total_budget(('rumah_a', 1), 'keluar_makan') == 15000
+
+
+def test_lepas_application_idle_tidak_melepas_default(monkeypatch):
+    ditutup = []
+
+    class FakeApplication:
+        def __init__(self, nama):
+            self.nama = nama
+
+        async def shutdown(self):
+            ditutup.append(self.nama)
+
+    monkeypatch.setattr(webhook, 'TENANT_IDLE_DETIK', 60)
+    monkeypatch.setattr(webhook, 'applications', webhook.OrderedDict([
+        ('default', [FakeApplication('default'), 0]),
+        ('rumah_a', [FakeApplication('rumah_a'), 0]),
+        ('rumah_b', [FakeApplication('rumah_b'), webhook.time.time()]),
+    ]))
+
+    asyncio.run(webhook.lepas_application_idle())
+
+    assert ditutup == ['rumah_a']
+    assert list(webhook.applications) == ['default', 'rumah_b']
+
+
+def test_log_context_di_reset_setelah_request(monkeypatch):
+    monkeypatch.setattr(webhook, 'get_application', lambda tenant_id: None)
+
+    with webhook.app.test_request_context('/webhook', method='POST'):
+        assert webhook.flask_webhook_handler() == ('Internal Server Error', 500)
+
+    assert webhook.log_context.get() is None
+
+
+def jalankan_budget(args, user_id=1):
+    balasan = []
+
+    async def reply_text(text, **kwargs):
+        balasan.append(text)
+
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+    context = SimpleNamespace(args=args, bot_data={}, _chat_id=user_id)
+    asyncio.run(webhook.budget_command(update, context))
+    return balasan
+
+
+def test_budget_command_kategori_dengan_spasi(cold_start):
+    jalankan_budget(['Rumah', 'Tangga', '500000'])
+
+    assert webhook.budget_limits[PEMILIK] == {'keluar_rumahtangga': 500000}
+    tersimpan = json.loads((cold_start / 'budget.json').read_text())
+    assert tersimpan == {'default': {'1': {'keluar_rumahtangga': 500000}}}
+
+
+def test_budget_command_nominal_nol_menghapus_budget(cold_start):
+    jalankan_budget(['Makan', '100000'])
+    jalankan_budget(['makan', '0'])
+
+    assert webhook.budget_limits[PEMILIK] == {}
+
+
+def test_budget_command_format_tidak_valid(cold_start):
+    balasan = jalankan_budget(['Jajan', '100000'])
+
+    assert 'Format tidak valid' in balasan[0]
+    assert webhook.budget_limits.get(PEMILIK, {}) == {}
+
+
+def test_total_budget_reset_saat_bulan_berganti(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'budget_loaded', True)
+    webhook.budget_totals[(*PEMILIK, 'keluar_makan')] = ['2000-01', 90000]
+
+    assert webhook.get_total_budget(PEMILIK, 'keluar_makan') == 0
+    assert webhook.tambah_total_budget(PEMILIK, 'keluar_makan', 15000) == 15000
+    assert webhook.budget_totals[(*PEMILIK, 'keluar_makan')] == [webhook.bulan_sekarang(), 15000]
+
+
+def test_index_keterangan_lru_per_user(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'KETERANGAN_MAKS_PER_USER', 2)
+    monkeypatch.setattr(webhook, 'keterangan_index_loaded', True)
+
+    webhook.update_keterangan_index(PEMILIK, 'Bubur Ayam', 'keluar_makan')
+    webhook.update_keterangan_index(PEMILIK, 'Bayar Listrik', 'keluar_rumah')
+    webhook.update_keterangan_index(PEMILIK, 'bubur  ayam', 'keluar_makan')
+    webhook.update_keterangan_index(PEMILIK, 'Bensin', 'keluar_kendaraan')
+
+    assert list(webhook.keterangan_index[PEMILIK]) == ['bubur ayam', 'bensin']
+    assert webhook.get_saran_keterangan(PEMILIK, 'keluar_kendaraan') == ['Bensin', 'bubur  ayam']
+
+
+def test_index_keterangan_lru_jumlah_user(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'KETERANGAN_MAKS_USER', 2)
+    monkeypatch.setattr(webhook, 'keterangan_index_loaded', True)
+
+    webhook.update_keterangan_index(('default', 1), 'Bubur Ayam', 'keluar_makan')
+    webhook.update_keterangan_index(('default', 2), 'Bubur Ayam', 'keluar_makan')
+    webhook.update_keterangan_index(('default', 1), 'Bensin', 'keluar_kendaraan')
+    webhook.update_keterangan_index(('default', 3), 'Bubur Ayam', 'keluar_makan')
+
+    assert list(webhook.keterangan_index) == [('default', 1), ('default', 3)]
+
+
+def test_kategori_dominan_dan_tombol_ganti_kategori(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'keterangan_index_loaded', True)
+    for kategori in ('keluar_makan', 'keluar_makan', 'keluar_belanja'):
+        webhook.update_keterangan_index(PEMILIK, 'Bubur Ayam', kategori)
+
+    saran = webhook.get_kategori_dominan(PEMILIK, 'bubur ayam', webhook.KATEGORI_KELUAR)
+    assert saran == ('Makan', 'keluar_makan')
+    assert webhook.get_kategori_dominan(PEMILIK, 'bubur ayam', webhook.KATEGORI_MASUK) is None
+
+    query = FakeQuery('saran_kategori', 1)
+    user_data = {
+        'transaksi': 'Keluar', 'kategori_nama': 'Belanja', 'kategori_data': 'keluar_belanja',
+        'nominal': 15000, 'keterangan': 'Bubur Ayam', 'saran_kategori': saran,
+    }
+    context = SimpleNamespace(user_data=user_data, bot_data={}, _chat_id=1)
+    state = asyncio.run(webhook.pilih_saran_kategori(SimpleNamespace(callback_query=query), context))
+
+    assert state == webhook.PREVIEW
+    assert (user_data['kategori_nama'], user_data['kategori_data']) == ('Makan', 'keluar_makan')
+    assert 'saran_kategori' not in user_data
+    assert '*Kategori:* Makan' in query.edits[0]
+
+
+def jalankan_rutin_command(args, user_id=1):
+    balasan = []
+
+    async def reply_text(text, **kwargs):
+        balasan.append(text)
+
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, first_name='A', username='a'),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+    context = SimpleNamespace(args=args, bot_data={}, _chat_id=user_id)
+    asyncio.run(webhook.rutin_command(update, context))
+    return balasan
+
+
+@pytest.mark.parametrize('nomor', ['0', '-1', '3', 'x'])
+def test_rutin_hapus_menolak_nomor_di_luar_daftar(cold_start, nomor):
+    webhook.tambah_rutin('default', 1, 1, 5, payload(1000), 'keluar_makan')
+    webhook.tambah_rutin('default', 1, 1, 6, payload(2000), 'keluar_makan')
+
+    balasan = jalankan_rutin_command(['hapus', nomor])
+
+    assert 'tidak valid' in balasan[0]
+    assert len(webhook.get_rutin_user(PEMILIK)) == 2
+
+
+def test_rutin_memuat_ulang_storage_sebelum_cron_dan_tulis(cold_start, monkeypatch):
+    terkirim = []
+    monkeypatch.setattr(webhook, 'send_to_make', lambda data, url=None: terkirim.append(data) or True)
+
+    async def tanpa_notifikasi(notifikasi, bots, batas):
+        pass
+    monkeypatch.setattr(webhook, 'kirim_notifikasi_rutin', tanpa_notifikasi)
+
+    job = webhook.tambah_rutin('default', 1, 1, 5, payload(1000), 'keluar_makan')
+    # Instance lain mendaftarkan job baru langsung ke storage
+    lain = dict(job, id='lain0001', jatuh_tempo=0, payload=payload(2000))
+    data = json.loads((cold_start / 'rutin.json').read_text())
+    data['lain0001'] = lain
+    (cold_start / 'rutin.json').write_text(json.dumps(data))
+
+    # Tulis dari instance ini tidak boleh menimpa job milik instance lain
+    webhook.tambah_rutin('default', 1, 1, 6, payload(3000), 'keluar_makan')
+    assert 'lain0001' in json.loads((cold_start / 'rutin.json').read_text())
+
+    assert asyncio.run(webhook.jalankan_rutin()) == 1
+    assert [p['nominal'] for batch in terkirim for p in batch] == [2000]
+
+
+def test_rutin_menolak_pendaftaran_tanpa_storage(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'RUTIN_PATH', None)
+    webhook.setelah_terkirim('default', payload(1000), 'keluar_makan')
+
+    balasan = jalankan_rutin_command(['5'])
+
+    assert 'RUTIN_PATH' in balasan[0]
+    assert webhook.rutin_jobs == {}
+
+
+def test_jalankan_rutin_tetap_menguras_saat_satu_webhook_gagal(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'TENANTS', {
+        'rumah_a': webhook.buat_tenant('rumah_a', {'bot_token': 'a', 'make_webhook_url': 'https://a', 'sheet_url': 'https://sa'}),
+        'rumah_b': webhook.buat_tenant('rumah_b', {'bot_token': 'b', 'make_webhook_url': 'https://b', 'sheet_url': 'https://sb'}),
+    })
+    monkeypatch.setattr(webhook, 'RUTIN_BATCH_SIZE', 2)
+    terkirim = []
+
+    def send_to_make(data, url=None):
+        terkirim.append((url, len(data)))
+        return url != 'https://a'
+    monkeypatch.setattr(webhook, 'send_to_make', send_to_make)
+
+    async def tanpa_notifikasi(notifikasi, bots, batas):
+        pass
+    monkeypatch.setattr(webhook, 'kirim_notifikasi_rutin', tanpa_notifikasi)
+
+    for tenant_id in ('rumah_a', 'rumah_a', 'rumah_b', 'rumah_b'):
+        webhook.tambah_rutin(tenant_id, 1, 1, 5, payload(1000), 'keluar_makan')
+    jatuh_tempo_sekarang(list(webhook.rutin_jobs))
+
+    assert asyncio.run(webhook.jalankan_rutin()) == 2
+    assert sum(n for url, n in terkirim if url == 'https://a') == 2
+    assert sum(n for url, n in terkirim if url == 'https://b') == 2
+    masih_jatuh_tempo = [job['tenant_id'] for job in webhook.rutin_jobs.values() if job['jatuh_tempo'] == 0]
+    assert masih_jatuh_tempo == ['rumah_a', 'rumah_a']
+
+
+def test_rutin_endpoint_wajib_cron_secret_di_vercel(monkeypatch):
+    monkeypatch.setattr(webhook, 'CRON_SECRET', None)
+    monkeypatch.setattr(webhook, 'CRON_SECRET_WAJIB', True)
+    monkeypatch.setattr(webhook, 'jalankan_rutin', lambda: pytest.fail('cron tidak boleh jalan'))
+
+    with webhook.app.test_request_context('/rutin'):
+        assert webhook.flask_rutin_handler() == ('Service Unavailable', 503)
+
+    monkeypatch.setattr(webhook, 'CRON_SECRET', 'rahasia')
+    with webhook.app.test_request_context('/rutin', headers={'Authorization': 'Bearer salah'}):
+        assert webhook.flask_rutin_handler() == ('Unauthorized', 401)
+
+
+def test_load_tenants_menolak_tenant_tanpa_webhook_atau_sheet(tmp_path, monkeypatch):
+    registry = tmp_path / 'tenants.json'
+    registry.write_text(json.dumps({'tenants': {
+        'lengkap': {'bot_token': 'a', 'make_webhook_url': 'https://a', 'sheet_url': 'https://sa'},
+        'tanpa_webhook': {'bot_token': 'b', 'sheet_url': 'https://sb'},
+        'tanpa_sheet': {'bot_token': 'c', 'make_webhook_url': 'https://c'},
+    }}))
+    monkeypatch.setattr(webhook, 'TENANTS_PATH', str(registry))
+    monkeypatch.setattr(webhook, 'TOKEN', None)
+
+    assert list(webhook.load_tenants()) == ['lengkap']
+
+
+def test_jalankan_rutin_melewati_job_tenant_tidak_dikenal(cold_start, monkeypatch):
+    monkeypatch.setattr(webhook, 'TENANTS', {})
+    terkirim = []
+    monkeypatch.setattr(webhook, 'send_to_make', lambda data, url=None: terkirim.append(url) or True)
+
+    webhook.tambah_rutin('rumah_hilang', 1, 1, 5, payload(1000), 'keluar_makan')
+    jatuh_tempo_sekarang(list(webhook.rutin_jobs))
+
+    assert asyncio.run(webhook.jalankan_rutin()) == 0
+    assert terkirim == []
+    assert [job['jatuh_tempo'] for job in webhook.rutin_jobs.values()] == [0]
+
+
+def test_warning_ditulis_tanpa_menunggu_listener(monkeypatch):
+    sync_handler = next(h for h in logging.getLogger().handlers if not isinstance(h, webhook.QueueHandler))
+    buffer = io.StringIO()
+    monkeypatch.setattr(sync_handler, 'stream', buffer)
+
+    logging.info("info lewat antrean")
+    logging.warning("peringatan langsung")
+
+    baris = [json.loads(line) for line in buffer.getvalue().splitlines()]
+    assert [b['msg'] for b in baris] == ["peringatan langsung"]
+
+
+def test_dengan_log_state_mengisi_state_sebelum_dan_sesudah_handler():
+    selama_handler = []
+
+    async def handler(update, context):
+        selama_handler.append(webhook.log_context.get()['state'])
+        return webhook.GET_DESCRIPTION
+
+    async def batal(update, context):
+        selama_handler.append(webhook.log_context.get()['state'])
+        return webhook.ConversationHandler.END
+
+    context = SimpleNamespace(user_data={})
+    token = webhook.log_context.set(webhook.buat_log_context())
+    try:
+        asyncio.run(webhook.dengan_log_state(handler, webhook.GET_NOMINAL)(None, context))
+        assert webhook.log_context.get()['state'] == 'GET_DESCRIPTION'
+
+        asyncio.run(webhook.dengan_log_state(batal)(None, context))
+        assert webhook.log_context.get()['state'] == 'END'
+    finally:
+        webhook.log_context.reset(token)
+
+    assert selama_handler == ['GET_NOMINAL', 'GET_DESCRIPTION']
+
+
+def buat_record(level, msg='pesan'):
+    return logging.LogRecord('root', level, __file__, 1, msg, None, None)
+
+
+def test_log_context_filter_membuang_info_yang_tidak_tersampel():
+    filter_ = webhook.LogContextFilter()
+    token = webhook.log_context.set(webhook.buat_log_context(sampled=False))
+    try:
+        assert not filter_.filter(buat_record(logging.INFO))
+        assert filter_.filter(buat_record(logging.WARNING))
+        assert filter_.filter(buat_record(logging.ERROR))
+    finally:
+        webhook.log_context.reset(token)
+
+
+def test_json_formatter_menyertakan_field_konteks():
+    record = buat_record(logging.INFO, 'transaksi terkirim')
+    token = webhook.log_context.set(webhook.buat_log_context(update_id=7, chat_id=-100, state='PREVIEW', sampled=True))
+    try:
+        assert webhook.LogContextFilter().filter(record)
+    finally:
+        webhook.log_context.reset(token)
+
+    data = json.loads(webhook.JsonFormatter().format(record))
+
+    assert data['msg'] == 'transaksi terkirim'
+    assert (data['update_id'], data['chat_id'], data['state']) == (7, -100, 'PREVIEW')
+    assert data['latency_ms'] >= 0